@@ -42,7 +42,18 @@ contained in the LICENSE.txt file.
 }
 """
 
-import json, http, os, sys, email, smtplib, requests, argparse, time, datetime, asyncio, threading
+import json, http, os, sys, email, smtplib, requests, argparse, time, datetime, threading, bisect, tempfile, signal
+from dataclasses import dataclass
+from requests.adapters import HTTPAdapter
+
+# Use orjson for the sensor and state (de)serialization if it's available, it's quite a bit faster
+try:
+	import orjson
+	json_loads = orjson.loads
+	json_dumps = orjson.dumps
+except ImportError:
+	json_loads = json.loads
+	json_dumps = lambda obj: json.dumps(obj).encode()
 
 argparse = argparse.ArgumentParser(description='Simple alert system for poor air quality')
 argparse.add_argument('--config', type=str, dest='config', default='/etc/air-alert.json', help='Path to the air quality alert config')
@@ -70,45 +81,83 @@ def get_or_set_default(section, name, default):
 	except:
 		raise Exception()
 
-# Try to set the sensors from the config. Default if it's not possible
-sensors = get_or_set_default(cfg, 'sensors', ["61605", "61217", "38085", "60059"])
+"""
+Turns an email text from the config into a str.format template, so both
+placeholders can be filled in with a single pass over the text
+"""
+def compile_email_template(text: str) -> str:
+	text = text.replace('{', '{{').replace('}', '}}')
+	return text.replace('$LEVEL_STRING', '{level}').replace('$AQI', '{aqi}')
+
+"""
+Resolved application config. Built once at startup from the config file
+"""
+@dataclass(frozen=True, slots=True)
+class Config():
+	sensors: list
+	login_required: bool
+	email_addr: str
+	email_pw: str
+	smtp_addr: str
+	smtp_port: int
+	addresses: list
+	use_tls: bool
+	report_threshold: float
+	sender_email: str
+	cooldown_time: float
+	update_period: float
+	status_email_hour: int # The hour at which to send the email
+	normal_email_text: str
+	unhealthy_email_text: str
+	status_email_text: str
+	air_qualities: dict
+	proxies: dict
 
 # Try to set various params
 if not cfg:
 	cfg = dict()
 	cfg['email'] = None
-login_required = get_or_set_default(cfg['email'], 'login_required', False)
-email_addr = get_or_set_default(cfg['email'], 'email_addr', "")
-email_pw = get_or_set_default(cfg['email'], 'email_pw', "")
-smtp_addr = get_or_set_default(cfg['email'], 'smtp_addr', "")
-smtp_port = get_or_set_default(cfg['email'], 'smtp_port', 0)
-addresses = get_or_set_default(cfg['email'], 'addresses', [])
-use_tls = get_or_set_default(cfg['email'], 'use_tls', True)
-report_threshold = get_or_set_default(cfg, 'report_threshold', 150)
-sender_email = get_or_set_default(cfg['email'], 'sender_email', '')
-cooldown_time = get_or_set_default(cfg, 'cooldown_time', 15)
-update_period = get_or_set_default(cfg, 'update_period', 60)
-status_email_hour = get_or_set_default(cfg, 'status_email_hour', 6) # The hour at which to send the email
-normal_email_text = get_or_set_default(cfg, 'normal_email_text', 'Configuration Error')
-unhealthy_email_text = get_or_set_default(cfg, 'unhealthy_email_text', 'Configuration Error')
-status_email_text = get_or_set_default(cfg, 'status_email_text', 'Configuration Error')
-air_qualities = get_or_set_default(cfg, 'qualities', {})
-proxies = get_or_set_default(cfg, 'proxies', {})
+CFG = Config(
+	sensors = get_or_set_default(cfg, 'sensors', ["61605", "61217", "38085", "60059"]),
+	login_required = get_or_set_default(cfg['email'], 'login_required', False),
+	email_addr = get_or_set_default(cfg['email'], 'email_addr', ""),
+	email_pw = get_or_set_default(cfg['email'], 'email_pw', ""),
+	smtp_addr = get_or_set_default(cfg['email'], 'smtp_addr', ""),
+	smtp_port = get_or_set_default(cfg['email'], 'smtp_port', 0),
+	addresses = get_or_set_default(cfg['email'], 'addresses', []),
+	use_tls = get_or_set_default(cfg['email'], 'use_tls', True),
+	report_threshold = get_or_set_default(cfg, 'report_threshold', 150),
+	sender_email = get_or_set_default(cfg['email'], 'sender_email', ''),
+	cooldown_time = get_or_set_default(cfg, 'cooldown_time', 15),
+	update_period = get_or_set_default(cfg, 'update_period', 60),
+	status_email_hour = get_or_set_default(cfg, 'status_email_hour', 6),
+	normal_email_text = compile_email_template(get_or_set_default(cfg, 'normal_email_text', 'Configuration Error')),
+	unhealthy_email_text = compile_email_template(get_or_set_default(cfg, 'unhealthy_email_text', 'Configuration Error')),
+	status_email_text = compile_email_template(get_or_set_default(cfg, 'status_email_text', 'Configuration Error')),
+	air_qualities = get_or_set_default(cfg, 'qualities', {}),
+	proxies = get_or_set_default(cfg, 'proxies', {}),
+)
+# Latest sensor readings. grab_sensors builds a new list and swaps it in rather than
+# modifying this one, so readers on other threads always see a complete set of readings
 sensor_data = []
+sensor_fetch_time = None # time.monotonic() of the last fetch
+sensor_fetch_ttl = 60 # Seconds that fetched sensor data is reused for, so back-to-back callers don't refetch
+
+# Shared HTTP session so connections to purpleair are pooled between requests
+# Keep-alive connections are reused on every poll instead of reconnecting each time
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=16))
+http_timeout = 10 # Seconds to wait on purpleair before giving up
+
+# Upper AQI bound of each quality level, and the matching description for each level
+aqi_string_bounds = (50, 100, 150, 200, 300)
+aqi_strings = tuple(CFG.air_qualities.get(k, 'Configuration Error') for k in ('good', 'moderate', 'unhealthy_s', 'unhealthy', 'unhealthy_v', 'hazardous'))
+# Older configs spelled the very unhealthy level 'vunhealthy'
+if 'unhealthy_v' not in CFG.air_qualities and 'vunhealthy' in CFG.air_qualities:
+	aqi_strings = aqi_strings[:4] + (CFG.air_qualities['vunhealthy'],) + aqi_strings[5:]
 
 def get_aqi_string(aqi):
-	if aqi <= 50:
-		return air_qualities['good']
-	elif aqi <= 100:
-		return air_qualities['moderate']
-	elif aqi <= 150:
-		return air_qualities['unhealthy_s']
-	elif aqi <= 200:
-		return air_qualities['unhealthy']
-	elif aqi <= 300:
-		return air_qualities['unhealthy_v']
-	else:
-		return air_qualities['hazardous']
+	return aqi_strings[bisect.bisect_left(aqi_string_bounds, aqi)]
 
 """
 GlobalState class which handles any and all global state.
@@ -118,14 +167,18 @@ class GlobalState():
 	def __init__(self, state_save_file: str):
 		self.file = state_save_file
 		self.data = dict()
+		self.dirty = False # Set when the data has changed since it was last saved
 		if os.path.exists(state_save_file):
 			self.load()
 		else:
 			# Just write out an empty file 
+			self.dirty = True
 			self.save()
 
 	def set_value(self, key: str, val):
-		self.data[key] = val
+		if key not in self.data or self.data[key] != val:
+			self.data[key] = val
+			self.dirty = True
 	
 	def get_value(self, key: str, default=None):
 		try:
@@ -133,82 +186,208 @@ class GlobalState():
 		except:
 			return default
 	
+	"""
+	Saves the state if anything has changed. The file is written to a temporary
+	file first and then swapped in, so a crash can't leave a half-written state file behind.
+	If the directory isn't writable the file is overwritten in place instead
+	"""
 	def save(self):
-		with open(self.file, "w") as fp:
-			json.dump(self.data, fp)
+		if not self.dirty:
+			return
+		content = json_dumps(self.data)
+		try:
+			fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.file)))
+		except PermissionError:
+			with open(self.file, "wb") as fp:
+				self.write_synced(fp, content)
+			self.dirty = False
+			return
+		try:
+			with os.fdopen(fd, "wb") as fp:
+				self.write_synced(fp, content)
+			# mkstemp creates the file as 0600, give it the mode the state file already had
+			try:
+				mode = os.stat(self.file).st_mode & 0o777
+			except FileNotFoundError:
+				mode = 0o644
+			os.chmod(tmp, mode)
+			os.replace(tmp, self.file)
+		except:
+			os.unlink(tmp)
+			raise
+		self.dirty = False
+
+	"""
+	Writes the data and makes sure it's on disk before returning
+	"""
+	@staticmethod
+	def write_synced(fp, content: bytes):
+		fp.write(content)
+		fp.flush()
+		os.fsync(fp.fileno())
 
 	def load(self):
-		with open(self.file, "r") as fp:
-			self.data = json.load(fp)
+		with open(self.file, "rb") as fp:
+			self.data = json_loads(fp.read())
 			if not self.data:
 				self.data = dict()
 
 # Global state object
 state = GlobalState(args.statefile)
 
+max_send_attempts = 5 # Failed sends of one email before it's dropped from the queue
+
+"""
+Returns True for SMTP errors that will happen again no matter how often the email is resent
+"""
+def is_permanent_smtp_error(e: Exception) -> bool:
+	if isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPNotSupportedError)):
+		return True
+	return isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500
+
 class EmailProvider():
 	def __init__(self):
-		log("Connecting to SMTP server at {0}:{1}".format(smtp_addr, smtp_port))
-		self.smtp_server = smtplib.SMTP(smtp_addr, int(smtp_port))
+		# The connection is opened the first time an email is sent, an idle one would just get dropped by the server
+		self.smtp_server = None
+		# [message, failed send attempts] waiting to be sent on the next flush()
+		self.pending = []
+		# Recipients never change, so only join them once
+		self.recipients = ", ".join(CFG.addresses)
+		# (sensor list, summary built from it). Kept as one tuple so both threads see a matching pair
+		self.summary_cache = (None, "")
+
+	def connect(self):
+		log("Connecting to SMTP server at {0}:{1}".format(CFG.smtp_addr, CFG.smtp_port))
+		self.smtp_server = smtplib.SMTP(CFG.smtp_addr, int(CFG.smtp_port))
 		self.smtp_server.ehlo() 
-		if use_tls:
+		if CFG.use_tls:
 			self.smtp_server.starttls()
-		if login_required:
-			try: 
-				self.smtp_server.login(email_addr, email_pw)
-			except:
-				log("Fatal error: Login failed")
-				exit(1)
-	
-	def send_high_email(self, aqi):
-		msg = email.message.EmailMessage()
-		# Collect recipients
-		msg['To'] = ", ".join(addresses)
-		msg['From'] = sender_email
-		msg['Subject'] = 'Air Quality Alert'
+		if CFG.login_required:
+			self.smtp_server.login(CFG.email_addr, CFG.email_pw)
 
-		content = unhealthy_email_text.replace('$LEVEL_STRING', get_aqi_string(aqi)).replace('$AQI', str(aqi))
-		content += "A summary of the sensor data follows:\n\n"
-
-		for sens in sensor_data:
-			content += "Location: {0}\nLast sampled: {1}\nAQI: {2}\n\n".format(sens.label, sens.pretty_last_seen(), int(sens.calc_aqi()))
-
-		msg.set_content(content)
-		self.smtp_server.send_message(msg)
+	"""
+	Connects and logs in once so bad SMTP settings are caught at startup rather than at the first email
+	"""
+	def check_login(self):
+		try:
+			self.connect()
+			self.smtp_server.quit()
+		except OSError as e: # Also covers SMTPException
+			log("Fatal error: Login failed: {0}".format(e))
+			exit(1)
+		finally:
+			self.disconnect()
 
-	def send_low_email(self, aqi):
+	"""
+	Returns a live SMTP connection, reconnecting if the old one has been dropped
+	"""
+	def get_server(self):
+		if self.smtp_server is not None:
+			try:
+				if self.smtp_server.noop()[0] == 250:
+					return self.smtp_server
+			except OSError: # Also covers SMTPServerDisconnected
+				pass
+			self.disconnect()
+		self.connect()
+		return self.smtp_server
+
+	def disconnect(self):
+		if self.smtp_server is not None:
+			try:
+				self.smtp_server.close()
+			except:
+				pass
+			self.smtp_server = None
+	
+	"""
+	Builds the per-sensor section of the email body.
+	It's only rebuilt when the sensor data has been updated since the last email
+	"""
+	def build_summary(self, data: list) -> str:
+		cached_data, summary = self.summary_cache
+		if cached_data is not data:
+			summary = "".join(f"Location: {sens.label}\nLast sampled: {sens.pretty_last_seen()}\nAQI: {sens.calc_aqi()}\n\n" for sens in data)
+			self.summary_cache = (data, summary)
+		return summary
+
+	def build_message(self, subject: str, template: str, aqi, data: list, header: str = ""):
 		msg = email.message.EmailMessage()
-		# Collect recipients
-		msg['To'] = ", ".join(addresses)
-		msg['From'] = sender_email
-		msg['Subject'] = 'Air Quality Alert'
+		msg['To'] = self.recipients
+		msg['From'] = CFG.sender_email
+		msg['Subject'] = subject
+		content = template.format(level=get_aqi_string(aqi), aqi=aqi)
+		msg.set_content("".join((content, header, self.build_summary(data))))
+		return msg
 
-		content = normal_email_text.replace('$LEVEL_STRING', get_aqi_string(aqi)).replace('$AQI', str(aqi))
-		content += "A summary of the sensor data follows:\n\n"
-
-		for sens in sensor_data:
-			content += "Location: {0}\nLast sampled: {1}\nAQI: {2}\n\n".format(sens.label, sens.pretty_last_seen(), int(sens.calc_aqi()))
-
-		msg.set_content(content)
-		self.smtp_server.send_message(msg)
-
-	def send_status_email(self, aqi):
-		msg = email.message.EmailMessage()
-		# Collect recipients
-		msg['To'] = ", ".join(addresses)
-		msg['From'] = sender_email
-		msg['Subject'] = 'Daily Air Quality Summary'
+	def send_high_email(self, aqi, data: list):
+		msg = self.build_message('Air Quality Alert', CFG.unhealthy_email_text, aqi, data, "A summary of the sensor data follows:\n\n")
+		self.pending.append([msg, 0])
 
-		content = status_email_text.replace('$LEVEL_STRING', get_aqi_string(aqi)).replace('$AQI', str(aqi))
+	def send_low_email(self, aqi, data: list):
+		msg = self.build_message('Air Quality Alert', CFG.normal_email_text, aqi, data, "A summary of the sensor data follows:\n\n")
+		self.pending.append([msg, 0])
 
-		for sens in sensor_data:
-			content += "Location: {0}\nLast sampled: {1}\nAQI: {2}\n\n".format(sens.label, sens.pretty_last_seen(), int(sens.calc_aqi()))
+	def send_status_email(self, aqi, data: list):
+		msg = self.build_message('Daily Air Quality Summary', CFG.status_email_text, aqi, data)
+		self.pending.append([msg, 0])
 
-		msg.set_content(content)
-		self.smtp_server.send_message(msg)
+	"""
+	Sends all of the queued emails over a single SMTP session.
+	Both threads share the one connection, so sending is serialized on email_mutex
+	Returns True if the queue was emptied, False if messages are left for a later flush
+	"""
+	def flush(self) -> bool:
+		with email_mutex:
+			first = True
+			while self.pending:
+				entry = self.pending[0]
+				msg = entry[0]
+				try:
+					server = self.get_server()
+				except OSError as e:
+					# Not the message's fault, keep everything queued for the next flush
+					log("Failed to connect to the SMTP server: {0}".format(e))
+					self.disconnect()
+					return False
+				try:
+					# Reset the transaction between messages rather than reconnecting
+					if not first:
+						server.rset()
+					server.send_message(msg)
+				except OSError as e: # Also covers SMTPException
+					log("Failed to send email '{0}': {1}".format(msg['Subject'], e))
+					# Drop the connection so the next flush reconnects
+					self.disconnect()
+					first = True
+					entry[1] += 1
+					if is_permanent_smtp_error(e) or entry[1] >= max_send_attempts:
+						# Retrying won't help, drop it so it doesn't hold up the rest of the queue
+						log("Giving up on email '{0}'".format(msg['Subject']))
+						self.pending.pop(0)
+						continue
+					# Keep the message queued so it goes out first on the next flush
+					return False
+				self.pending.pop(0)
+				first = False
+			return True
 
 email_provider = EmailProvider()
 email_mutex = threading.Lock()
+# Set to stop the daemon, waiting on it instead of sleeping lets a shutdown interrupt the wait
+shutdown_event = threading.Event()
+
+# AQI breakpoints as (conc_lo, conc_hi, aqi_lo, aqi_hi), one entry per category.
+# Concentrations are in tenths of a ug/m3 so the whole calculation can be done with integers
+aqi_breakpoints = (
+	(0, 120, 0, 50),
+	(121, 354, 51, 100),
+	(355, 554, 101, 150),
+	(555, 1504, 151, 200),
+	(1505, 2504, 201, 300),
+	(2505, 5004, 301, 500),
+)
+aqi_conc_upper = tuple(bp[1] for bp in aqi_breakpoints[:-1])
 
 """
 Simple class that manages json data for each sensor
@@ -216,36 +395,53 @@ Check is_valid to ensure that the sensor data is valid
 """
 class SensorJSON():
 	"""
-	Reads sensor data from an individual sensor
+	Reads the data for all of the given sensors with a single request.
+	Returns one SensorJSON per sensor id, in the same order
 	"""
 	@staticmethod
-	def read_sensor(sensor: str):
-		req = requests.get('http://www.purpleair.com/json?show={0}'.format(sensor), proxies=proxies)
-		if(req.status_code != 200):
-			print("Failed to get sensor data for sensor with id {0}".format(sensor))
-		return SensorJSON(req.content)
-
-	def __init__(self, val: bytes):
-		self.json = json.loads(val)
+	def read_sensors(sensors: list) -> list:
+		ids = [str(sensor) for sensor in sensors]
+		req = http_session.get('https://www.purpleair.com/json?show={0}'.format('|'.join(ids)), proxies=CFG.proxies, timeout=http_timeout)
+		# An error response isn't sensor data, don't try to parse it
+		req.raise_for_status()
+		payload = json_loads(req.content)
+		results = payload.get('results') if isinstance(payload, dict) else None
+		# The secondary channel of each sensor is also returned, those entries have a ParentID set
+		by_id = {str(r.get('ID')): r for r in results or [] if r.get('ParentID') is None}
+		return [SensorJSON(by_id.get(sensor)) for sensor in ids]
+
+	"""
+	Creates a sensor from an already parsed entry of the results list.
+	A missing entry (None) gives an invalid sensor
+	"""
+	def __init__(self, result: dict):
+		self.result = result
 		self.valid = True # Set to false if we're not valid 
 		self.label = self.get_field('Label') or 'None'
 		self.temp = self.get_field('temp_f') or 0 
 		self.last_seen = self.get_field('LastSeen') or 0
 		self.pm25 = self.get_field('PM2_5Value') or 0.0
 		self.aqi = None 
+		self.last_seen_str = None
+		self.last_seen_str_ts = None
 
+	"""
+	Returns last_seen as a formatted date string. The string is cached until last_seen changes
+	"""
 	def pretty_last_seen(self):
-		return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.last_seen))
+		if self.last_seen_str_ts != self.last_seen:
+			self.last_seen_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.last_seen))
+			self.last_seen_str_ts = self.last_seen
+		return self.last_seen_str
 
 	"""
 	Returns the specified field or None if not found.
 	"""
 	def get_field(self, name: str):
-		try:
-			return self.json['results'][0][name]
-		except:
-			self.valid = False 
-			return None 
+		value = self.result.get(name) if self.result else None
+		if value is None:
+			self.valid = False
+		return value
 
 	def is_valid(self) -> bool:
 		return self.valid 
@@ -253,68 +449,61 @@ class SensorJSON():
 	"""
 	Calculates the AQI based on this sensor's data.
 	This isn't an average value, only the current one returned by the sensor
-	What a horrible function! 
 	Equation documented at: https://forum.airnowtech.org/t/the-aqi-equation/169
+	The concentration is truncated to 0.1 ug/m3 and the AQI rounded to the nearest integer, as the EPA does
+	The result is cached, since the sensor data doesn't change after it's read
 	"""
-	def calc_aqi(self) -> float:
-		conc_in = float(self.pm25)
-		aqi_lo = 0.0
-		aqi_hi = 0.0
-		conc_lo = 0.0
-		conc_hi = 0.0
-		if conc_in > 250.5:
-			conc_lo = 250.5
-			conc_hi = 500.4
-			aqi_lo = 301.0
-			aqi_hi = 500.0
-		elif conc_in > 150.5:
-			conc_lo = 150.5
-			conc_hi = 250.4
-			aqi_lo = 201.0 
-			aqi_hi = 300.0 
-		elif conc_in > 55.5:
-			conc_lo = 55.5
-			conc_hi = 150.4
-			aqi_lo = 151.0
-			aqi_hi = 200.0
-		elif conc_in > 35.5:
-			conc_lo = 35.5
-			conc_hi = 55.4
-			aqi_lo = 101.0 
-			aqi_hi = 150.0 
-		elif conc_in > 12.1:
-			conc_lo = 12.1 
-			conc_hi = 35.4
-			aqi_lo = 51.0
-			aqi_hi = 100.0
-		else:
-			conc_lo = 0.0
-			conc_hi = 12.0
-			aqi_lo = 0.0
-			aqi_hi = 50.0
-		return ((aqi_hi-aqi_lo)/(conc_hi-conc_lo)) * (conc_in - conc_lo) + aqi_lo 
-		
+	def calc_aqi(self) -> int:
+		if self.aqi is not None:
+			return self.aqi
+		# Round off float noise first so e.g. 2.3 doesn't truncate to 22 tenths
+		conc_in = int(round(float(self.pm25) * 10, 6))
+		conc_lo, conc_hi, aqi_lo, aqi_hi = aqi_breakpoints[bisect.bisect_left(aqi_conc_upper, conc_in)]
+		num = (aqi_hi - aqi_lo) * (conc_in - conc_lo)
+		den = conc_hi - conc_lo
+		self.aqi = aqi_lo + (2 * num + den) // (2 * den)
+		return self.aqi
+
+"""
+Calculates the AQI of every sensor in one pass and returns them as a list.
+The results are cached on each sensor, so the email summaries don't recompute them
+"""
+def calc_all_aqi(data: list) -> list:
+	return [sens.calc_aqi() for sens in data]
 
 """
 Grabs the latest sensor data from the sensors in the sensor list 
+All of the sensors are fetched with one request, so the total time is one round trip
+Data fetched within the last sensor_fetch_ttl seconds is reused instead of being fetched again
+If the fetch fails, the previous sensor data is kept and returned
 """
-def grab_sensors():
-	sensor_data.clear()
-	for sensor in sensors:
-		sensor_data.append(SensorJSON.read_sensor(sensor))
+def grab_sensors() -> list:
+	global sensor_data, sensor_fetch_time
+	if sensor_data and sensor_fetch_time is not None and time.monotonic() - sensor_fetch_time < sensor_fetch_ttl:
+		return sensor_data
+	try:
+		data = SensorJSON.read_sensors(CFG.sensors)
+	except (requests.RequestException, ValueError) as e: # ValueError covers bad JSON from both json and orjson
+		log("Failed to get sensor data: {0}".format(e))
+		return sensor_data
+	# Swapping the reference is atomic, so no lock is needed for readers
+	sensor_data = data
+	sensor_fetch_time = time.monotonic()
+	return data
 
 
 def newmain():
+	# Work from one snapshot so the alert AQI and the email summary come from the same fetch
+	data = sensor_data
 	if args.DAEMON:
 		log("Populating sensor data...")
-		grab_sensors()
+		data = grab_sensors()
 		log("Done.")
 
 	bad = False
 	aqi = 0
-	for sensor in sensor_data:
-		saqi = sensor.calc_aqi()
-		if saqi > report_threshold:
+	for saqi in calc_all_aqi(data):
+		if saqi > CFG.report_threshold:
 			bad = True
 			if saqi > aqi:
 				aqi = saqi
@@ -322,9 +511,12 @@ def newmain():
 		log("All sensors reported an AQI within the acceptable range.")
 		if state.get_value('was_high') is True:
 			log("Cooldown timer started....")
-			time.sleep(cooldown_time * 60) # Sleep for a cooldown time so we don't spam the email if we hover around a specific time
+			# Sleep for a cooldown time so we don't spam the email if we hover around a specific time
+			if shutdown_event.wait(CFG.cooldown_time * 60):
+				# Shutting down mid-cooldown, leave was_high set so the next run does the cooldown again
+				return
 			log("...Finished. Sending email")
-			email_provider.send_low_email(round(aqi))
+			email_provider.send_low_email(aqi, data)
 
 		state.set_value('was_high', False)
 		return
@@ -336,92 +528,92 @@ def newmain():
 		return
 	state.set_value('was_high', True)
 	state.set_value('last_report_time', time.time())
-	log("An AQI above {0} was detected. Sending alert email".format(report_threshold))
+	log("An AQI above {0} was detected. Sending alert email".format(CFG.report_threshold))
 
-	email_provider.send_high_email(round(aqi))
+	email_provider.send_high_email(aqi, data)
 
 def daily_email_thread():
-	while True:
-		# I hate nested loops 
-		while True:
-			now = datetime.datetime.now()
-			current_time = [now.hour, now.minute]
-			if current_time == [status_email_hour, 0]:
-				break 
-			else: 
-				time.sleep(20)
+	# The next time the status email is due, in local time
+	now = datetime.datetime.now()
+	target = now.replace(hour=CFG.status_email_hour, minute=0, second=0, microsecond=0)
+	if target <= now:
+		target += datetime.timedelta(days=1)
+	while not shutdown_event.is_set():
+		# timestamp() goes through mktime so DST changes are accounted for.
+		# Loop on it in case the wait ends early because the clock was adjusted
+		delay = target.timestamp() - time.time()
+		if delay > 0:
+			if shutdown_event.wait(delay):
+				return
+			continue
 		log("Sending daily status email")
-		email_mutex.acquire()
-		grab_sensors()
-		# TODO: Clean this up...
-		aqi = 0.0
-		for sensor in sensor_data:
-			saqi = sensor.calc_aqi()
-			if saqi > aqi:
-				aqi = saqi
-		email_provider.send_status_email(round(aqi))
-		email_mutex.release()
-		time.sleep(120) # Hack so the timer doesnt get triggered immediately again
+		data = grab_sensors()
+		aqi = max([0] + calc_all_aqi(data))
+		email_provider.send_status_email(aqi, data)
+		email_provider.flush()
+		# Move on to the next day, skipping any days missed while e.g. suspended
+		while target.timestamp() <= time.time():
+			target += datetime.timedelta(days=1)
 
 def main():
+	email_provider.check_login()
 	if args.DAEMON:	
+		signal.signal(signal.SIGTERM, lambda signum, frame: shutdown_event.set())
 		threading.Thread(target=daily_email_thread).start()
-		while True:
-			# This mutex is actually so we can send daily emails without screwing up the sensor data if we update the sensors on 2 different threads
-			email_mutex.acquire()
+		while not shutdown_event.is_set():
 			newmain()
-			email_mutex.release()
+			email_provider.flush()
 			state.save()
-			time.sleep(update_period * 60)
+			shutdown_event.wait(CFG.update_period * 60)
+		log("Shutting down")
 	else:
 		log("Populating sensor data...")
-		grab_sensors()
+		data = grab_sensors()
+		if not data:
+			return
 		log("Done.")
 		# Daily status email 
 		now = datetime.datetime.now()
-		if now.hour == status_email_hour and now.minute < 5: # Quick hack here...Just want to make sure that we run within the first 5 minutes of the hour.
-			# TODO: Clean this up...
-			aqi = 0.0
-			for sensor in sensor_data:
-				saqi = sensor.calc_aqi()
-				if saqi > aqi:
-					aqi = saqi
-			email_provider.send_status_email(round(aqi))
+		if now.hour == CFG.status_email_hour and now.minute < 5: # Quick hack here...Just want to make sure that we run within the first 5 minutes of the hour.
+			aqi = max([0] + calc_all_aqi(data))
+			email_provider.send_status_email(aqi, data)
 
 		# Handle the Normal reporting 
 		if args.DAEMON:
 			log("Populating sensor data...")
-			grab_sensors()
+			data = grab_sensors()
 			log("Done.")
 
 		# Remove the topmost outlier here and average the rest
-		aqi = 0.0
-		aqilist = []
-		for sensor in sensor_data:
-			aqilist.append(sensor.calc_aqi())
+		aqilist = calc_all_aqi(data)
 		aqilist.remove(max(aqilist)) # Average of two lowest 
 		aqi = max(aqilist)
 
 		# Hardcoded for now.........
 		last = state.get_value('last_aqi', default=0)
+		# The queue doesn't outlive this run, so last_aqi is only moved on once the emails
+		# have gone out. Otherwise the next run would never retry a failed one
 		if aqi < 45 and last > 50:
-			email_provider.send_low_email(round(aqi))
-			state.set_value('last_aqi', aqi)
-			state.save()
+			email_provider.send_low_email(aqi, data)
+			if email_provider.flush():
+				state.set_value('last_aqi', aqi)
+				state.save()
 		if aqi < 50:
+			email_provider.flush()
 			return 
 		
 		# Crossing the 50 threshold from below 
 		if aqi >= 50 and aqi < 100 and last < 50:
-			email_provider.send_high_email(round(aqi))
+			email_provider.send_high_email(aqi, data)
 		# Crossing the 50-100 threshold from above 
 		elif aqi >= 50 and aqi < 100 and last >= 100:
-			email_provider.send_high_email(round(aqi))
+			email_provider.send_high_email(aqi, data)
 		# Crossing the 100+ threshold from below 
 		elif aqi >= 100 and last < 100:
-			email_provider.send_high_email(round(aqi))
-		state.set_value('last_aqi', aqi)
-		state.save()
+			email_provider.send_high_email(aqi, data)
+		if email_provider.flush():
+			state.set_value('last_aqi', aqi)
+			state.save()
 
 if __name__ == "__main__":
 	main()
\ No newline at end of file